@@ -3,20 +3,26 @@ import os
 import re
 import math
 import glob
+import shutil
 import tempfile
+import zipfile
 import logging
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import date, datetime, timedelta
+from itertools import islice
 
 from flask import (
     Flask, request, send_file,
     render_template, flash,
     redirect, url_for
 )
+import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
+from lxml import etree, html as lh
+from python_calamine import CalamineWorkbook
 from openpyxl import Workbook, load_workbook
-from openpyxl.styles import PatternFill, Font, Alignment
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.read_only import EMPTY_CELL
+from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 from openpyxl.utils.datetime import from_excel
 
@@ -27,272 +33,386 @@ app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "replace-with-secure-random-key")
 
 # ——— Helper 1: Conditional formatting on a schedule workbook ——————————————————
-def apply_conditional_formatting(
-    input_path,
-    output_path,
-    sheet_name: str = "Schedule",
-    part_col_header: str = "PART",
-):
-    wb = load_workbook(input_path)
-    if sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-    else:
-        ws = wb[wb.sheetnames[0]]
+GREEN, YELLOW, RED = "C6EFCE", "FFEB9C", "FFC7CE"
+STOCK_RE = re.compile(r"\bStock\b", re.IGNORECASE)
+IT_RE = re.compile(r"IT\d+", re.IGNORECASE)
+XLSX_NS = {
+    "m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+}
+# Explicit header formats, tried in order before the free-form fallback
+DATE_FMTS = ("%d-%m-%Y", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%y%m%d", "%Y%m%d")
+
+
+def calamine_value(v):
+    """Map a calamine cell onto what openpyxl would have returned."""
+    if v == "":
+        return None
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    if type(v) is date:
+        return datetime(v.year, v.month, v.day)
+    return v
+
+
+def to_numbers(values):
+    """Coerce cell values to floats: commas are thousands separators, junk is 0."""
+    cells = pd.Series(values, dtype=object)
+    nums = pd.to_numeric(cells, errors="coerce")
+    retry = nums.isna() & cells.notna()
+    if retry.any():
+        nums[retry] = pd.to_numeric(
+            cells[retry].astype(str).str.replace(",", ""), errors="coerce"
+        )
+    return nums.fillna(0.0).to_numpy(dtype=np.float64)
+
+
+def parse_dates(values):
+    """
+    Parse header cells to dates (None where nothing matches).
+
+    datetimes and Excel serials are converted directly; strings are parsed
+    in one pd.to_datetime call per format in DATE_FMTS, then whatever is
+    left goes through a single dayfirst, format='mixed' pass.
+    """
+    out = [None] * len(values)
+    pending = {}
+    for i, v in enumerate(values):
+        if v is None:
+            continue
+        if isinstance(v, datetime):
+            out[i] = v.date()
+            continue
+        if isinstance(v, (int, float)):
+            try:
+                out[i] = from_excel(v).date()
+                continue
+            except (ValueError, TypeError, OverflowError):
+                pass
+        s = str(v).strip().strip('"\'')
+        if s:
+            pending[i] = s
+
+    for fmt in DATE_FMTS + (None,):
+        if not pending:
+            break
+        idx = list(pending)
+        strings = pd.Series([pending[i] for i in idx], dtype=object)
+        if fmt is None:
+            parsed = pd.to_datetime(strings, format="mixed", dayfirst=True, errors="coerce")
+        else:
+            parsed = pd.to_datetime(strings, format=fmt, errors="coerce")
+        for i, ts in zip(idx, parsed):
+            if not pd.isna(ts):
+                out[i] = ts.date()
+                del pending[i]
+    return out
+
+
+def read_sheets(input_path):
+    """Every sheet's cached cell values, in workbook order: [(title, rows), ...]."""
+    wb = CalamineWorkbook.from_path(input_path)
+    sheets = []
+    for title in wb.sheet_names:
+        values = wb.get_sheet_by_name(title).to_python(skip_empty_area=False)
+        sheets.append((title, [tuple(map(calamine_value, r)) for r in values]))
+    return sheets
+
+
+def read_freeze_panes(input_path):
+    """Top-left scrolling cell of every sheet with frozen panes: {title: 'B3'}."""
+    panes = {}
+    with zipfile.ZipFile(input_path) as z:
+        book = etree.fromstring(z.read("xl/workbook.xml"))
+        rels = etree.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+        targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+        for sheet in book.iterfind("m:sheets/m:sheet", XLSX_NS):
+            target = targets.get(sheet.get(f"{{{XLSX_NS['r']}}}id"))
+            if not target:
+                continue
+            path = target[1:] if target.startswith("/") else f"xl/{target}"
+            with z.open(path) as f:
+                # The sheet view sits ahead of the cell data; stop there
+                for _, el in etree.iterparse(f, events=("start",)):
+                    tag = etree.QName(el).localname
+                    if tag == "sheetData":
+                        break
+                    if tag == "pane" and el.get("state") in ("frozen", "frozenSplit"):
+                        cell = el.get("topLeftCell")
+                        if not cell:
+                            col = int(float(el.get("xSplit", 0))) + 1
+                            row = int(float(el.get("ySplit", 0))) + 1
+                            cell = f"{get_column_letter(col)}{row}"
+                        panes[sheet.get("name")] = cell
+                        break
+    return panes
+
+
+def carry_forward(mask):
+    """Index of the latest True week at or before each week (-1 if none)."""
+    weeks = np.arange(mask.shape[-1])
+    return np.maximum.accumulate(np.where(mask, weeks, -1), axis=-1)
+
+
+def simulate_coverage(wh_stock, arrived, values):
+    """
+    Coverage status for one part.
+
+    wh_stock is the warehouse stock, arrived[w] the IT quantity landed by
+    week w and values[row, week] the demand matrix. Returns uint8 status
+    codes per row/week (0=green, 1=yellow, 2=red) plus the first yellow and
+    first red week per row (n_weeks when never reached).
+    """
+    demand = values.sum(axis=0)
+    active = demand > 0
+
+    # Warehouse: cumulative shortfall once stock is used up, per-week gap
+    used = np.cumsum(np.where(active, demand, 0.0))
+    short = np.where(used > 0, np.maximum(used - wh_stock, 0.0), 0.0)
+    gap = np.diff(short, prepend=0.0)
 
+    # IT pool: pool = max(pool + arrivals - gap, 0) is a Lindley recursion,
+    # so a week goes red exactly when the running balance hits a new low
+    balance = np.cumsum(np.diff(arrived, prepend=0.0) - gap)
+    floor = np.minimum.accumulate(np.concatenate(([0.0], balance)))[:-1]
+    code = np.where(gap > 0, np.where(balance < floor, 2, 1), 0).astype(np.uint8)
+
+    # Weeks without demand keep the previous part status
+    last = carry_forward(active)
+    status = np.where(last >= 0, code[last], 0).astype(np.uint8)
+
+    # Rows only take the part status in weeks where they have demand
+    row_last = carry_forward(values > 0)
+    row_status = np.where(row_last >= 0, status[row_last], 0).astype(np.uint8)
+
+    # First yellow / red week per row
+    none = np.ones((values.shape[0], 1), dtype=bool)
+    first_y = np.argmax(np.hstack([row_status == 1, none]), axis=1)
+    first_r = np.argmax(np.hstack([row_status == 2, none]), axis=1)
+    return row_status, first_y, first_r
+
+
+def coverage_months(stock, demands):
+    """Non-zero demand weeks covered in order before stock first falls short."""
+    used = np.cumsum(demands[demands != 0])
+    # stock - used[k-1] >= d[k]  <=>  used[k] <= stock; stop at the first miss
+    return int(np.argmin(np.append(used <= stock, False)))
+
+
+def compute_colors(rows, part_col_header: str = "PART"):
+    """
+    Run the coverage simulation over the in-memory rows.
+
+    Returns (header_row, insert_idx, row_meta, cell_colors); rows and columns
+    are 1-based positions in the original sheet.
+    """
     # ── 1. Locate Headers ──────────────────────────────────────────────────────
     header_row = next(
         (
-            c.row
-            for r in ws.iter_rows(min_row=1, max_row=20)
-            for c in r
-            if c.value and re.search(r"\bStock\b", str(c.value), re.IGNORECASE)
+            r
+            for r, row in enumerate(rows[:20], 1)
+            for v in row
+            if v and STOCK_RE.search(str(v))
         ),
         None,
     )
     if header_row is None:
         raise ValueError("Header row with 'Stock' not found.")
 
-    headers = [c.value for c in ws[header_row]]
-    
+    headers = list(rows[header_row - 1])
+
     # Identify key columns
     try:
         stock_col = next(
-            i for i, h in enumerate(headers, 1) 
-            if h and re.search(r"\bStock\b", str(h), re.IGNORECASE)
+            i for i, h in enumerate(headers, 1)
+            if h and STOCK_RE.search(str(h))
         )
         part_col = next(
-            i for i, h in enumerate(headers, 1) 
+            i for i, h in enumerate(headers, 1)
             if h and re.search(part_col_header, str(h), re.IGNORECASE)
         )
     except StopIteration:
         raise ValueError("Could not find 'Stock' or Part column headers.")
-    
+
     # Identify IT columns (IT01, IT02...)
     it_col_indices = [
-        i for i, h in enumerate(headers, 1) 
-        if h and re.match(r"IT\d+", str(h), re.IGNORECASE)
+        i for i, h in enumerate(headers, 1)
+        if h and IT_RE.match(str(h))
     ]
 
-    # ── 2. Parse Dates (Flexible Parser) ──────────────────────────────────────
-    def parse_date(v):
-        if v is None: return None
-        try:
-            if isinstance(v, datetime): return v.date()
-        except: pass
-        if isinstance(v, (int, float)):
-            try: return from_excel(v).date()
-            except: pass
-        
-        s = str(v).strip().strip('"\'')
-        if not s: return None
-        
-        for fmt in ("%d-%m-%Y", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%y%m%d", "%Y%m%d"):
-            try: return datetime.strptime(s, fmt).date()
-            except: continue
-        
-        try:
-            pd_dt = pd.to_datetime(s, dayfirst=True, errors="coerce")
-            if not pd.isna(pd_dt): return pd_dt.date()
-        except: pass
-        return None
+    # ── 2. Parse Dates (batched) ──────────────────────────────────────────────
+    header_dates = parse_dates(headers)
 
-    it_cols = {} 
-    for idx in it_col_indices:
-        d = parse_date(headers[idx-1]) or parse_date(ws.cell(row=header_row, column=idx).value)
-        if not d and header_row > 1:
-            d = parse_date(ws.cell(row=header_row - 1, column=idx).value)
-        it_cols[idx] = d or datetime.min.date()
+    it_cols = {}
+    if header_row > 1:
+        above = parse_dates([rows[header_row - 2][idx-1] for idx in it_col_indices])
+    else:
+        above = [None] * len(it_col_indices)
+    for idx, d_above in zip(it_col_indices, above):
+        it_cols[idx] = header_dates[idx-1] or d_above or datetime.min.date()
 
-    req_cols = {} 
-    for idx, h in enumerate(headers, 1):
-        if idx not in it_col_indices and idx != stock_col:
-            d = parse_date(h)
-            if d:
-                req_cols[idx] = d
+    req_cols = {}
+    for idx, d in enumerate(header_dates, 1):
+        if idx not in it_col_indices and idx != stock_col and d:
+            req_cols[idx] = d
 
     sorted_reqs = sorted(req_cols.items(), key=lambda x: x[1])
 
-    # ── 3. Define Styles ──────────────────────────────────────────────────────
-    green = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-    yellow = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
-    red = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-    
-    # ── 4. Group Rows by Part ─────────────────────────────────────────────────
-    parts = defaultdict(list)
-    for r in range(header_row + 1, ws.max_row + 1):
-        part_val = ws.cell(row=r, column=part_col).value
-        if part_val is not None:
-            parts[part_val].append(r)
-
-    # ── 5. Processing Phase (Calculate & Store in Memory) ─────────────────────
-    
-    # We store calculations here first because we need to insert columns later,
-    # which changes cell indices.
-    row_meta = {}      # {row_idx: {'G': date, 'Y': date, 'R': date, 'wh': int, 'it': int}}
-    cell_colors = {}   # {row_idx: {old_col_idx: color_obj}}
-
-    def get_val(r, c):
-        v = ws.cell(r, c).value
-        if v is None: return 0.0
-        try:
-            return float(v)
-        except:
-            try:
-                return float(str(v).replace(',', '').strip())
-            except:
-                return 0.0
-
-    for part, rows in parts.items():
-        wh_stock = max(get_val(r, stock_col) for r in rows)
-        
-        it_supply = []
-        for col, date in it_cols.items():
-            qty = max(get_val(r, col) for r in rows) 
-            if qty > 0:
-                it_supply.append({'date': date, 'qty': qty})
-        it_supply.sort(key=lambda x: x['date'])
-
-        current_wh = wh_stock
-        current_it_pool = 0.0 
-        it_ptr = 0 
-        
-        # Determine Color Logic
-        last_row_color = {r: green for r in rows}
-        
-        # Track First Dates (Part Level or Row Level - User asked for Row Level dates)
-        # We will track first occurrences for each row individually
-        row_dates = {r: {'Y': None, 'R': None} for r in rows}
-
-        current_part_status = green
-
-        for col_idx, req_date in sorted_reqs:
-            # Update Pool
-            while it_ptr < len(it_supply) and it_supply[it_ptr]['date'] <= req_date:
-                current_it_pool += it_supply[it_ptr]['qty']
-                it_ptr += 1
-
-            # Demand Check
-            row_values = {r: get_val(r, col_idx) for r in rows}
-            weekly_demand = sum(row_values.values())
-
-            if weekly_demand > 0:
-                if current_wh >= weekly_demand:
-                    current_wh -= weekly_demand
-                    current_part_status = green
-                else:
-                    gap = weekly_demand - current_wh
-                    current_wh = 0
-                    if current_it_pool >= gap:
-                        current_it_pool -= gap
-                        current_part_status = yellow 
-                    else:
-                        current_it_pool = 0
-                        current_part_status = red
-            
-            date_str = req_date.strftime("%d-%m-%Y")
-
-            # Apply Logic to Rows
-            for r in rows:
-                val = row_values[r]
-                final_color = None
-                
-                if val > 0:
-                    final_color = current_part_status
-                    last_row_color[r] = current_part_status
-                else:
-                    final_color = last_row_color[r]
-                
-                # Store color for later application
-                if r not in cell_colors: cell_colors[r] = {}
-                cell_colors[r][col_idx] = final_color
-
-                # Capture First Date
-                if final_color == yellow and row_dates[r]['Y'] is None:
-                    row_dates[r]['Y'] = date_str
-                elif final_color == red and row_dates[r]['R'] is None:
-                    row_dates[r]['R'] = date_str
-
-        # Calculate Metrics (Months Coverage)
-        wh_calc = max(get_val(r, stock_col) for r in rows)
-        it_total_calc = sum(max(get_val(r, col) for r in rows) for col in it_cols.keys())
-        total_supply = wh_calc + it_total_calc
-        demands = [sum(get_val(r, col) for r in rows) for col, _ in sorted_reqs]
-        
-        def calc_coverage(stock, demand_list):
-            months = 0
-            for d in demand_list:
-                if d == 0: continue 
-                if stock >= d:
-                    stock -= d
-                    months += 1
-                else:
-                    break
-            return months
-
-        wh_months = calc_coverage(wh_calc, demands)
-        all_months = calc_coverage(total_supply, demands)
+    # ── 3. Group Rows by Part ─────────────────────────────────────────────────
+    # {part: positions into the body rows}; blank part cells are dropped
+    body = rows[header_row:]
+    part_vals = pd.Series([row[part_col-1] for row in body], dtype=object)
+    parts = part_vals.groupby(part_vals, sort=False).indices
+
+    # ── 4. Processing Phase (Calculate & Store in Memory) ─────────────────────
+    row_meta = {}      # {row_idx: {'Y': date, 'R': date, 'cov_wh': int, 'cov_it': int}}
+    cell_colors = {}   # {row_idx: {col_idx: color}}
+
+    # Dense float matrix of the columns we need: M[body_row, position]
+    wanted = [stock_col] + list(it_cols) + [col for col, _ in sorted_reqs]
+    stock_pos = 0
+    it_pos = list(range(1, 1 + len(it_cols)))
+    req_pos = list(range(1 + len(it_cols), len(wanted)))
+    M = to_numbers(
+        [row[c-1] for row in body for c in wanted]
+    ).reshape(len(body), len(wanted))
+
+    # Timeline shared by every part: arrive[i, w] once IT column i has landed
+    req_ids = [col for col, _ in sorted_reqs]
+    req_dates = np.array([d for _, d in sorted_reqs], dtype="datetime64[D]")
+    it_dates = np.array(list(it_cols.values()), dtype="datetime64[D]")
+    arrive = (it_dates[:, None] <= req_dates[None, :]).astype(np.float64)
+    date_strs = [d.strftime("%d-%m-%Y") for _, d in sorted_reqs] + [None]
+    palette = np.array([GREEN, YELLOW, RED], dtype=object)
+
+    for part, group in parts.items():
+        part_rows = (group + header_row + 1).tolist()
+        wh_stock = M[group, stock_pos].max()
+        it_qty = M[np.ix_(group, it_pos)].max(axis=0)
+        values = M[np.ix_(group, req_pos)]          # [row, week]
+        arrived = np.where(it_qty > 0, it_qty, 0.0) @ arrive
+        row_status, first_y, first_r = simulate_coverage(wh_stock, arrived, values)
+
+        colors = palette[row_status]
+        for i, r in enumerate(part_rows):
+            cell_colors[r] = dict(zip(req_ids, colors[i]))
+
+        # Calculate Metrics (Months Coverage) from the same supply figures
+        demands = values.sum(axis=0)
+        wh_months = coverage_months(wh_stock, demands)
+        all_months = coverage_months(wh_stock + it_qty.sum(), demands)
 
         # Save Metadata
-        for r in rows:
+        for i, r in enumerate(part_rows):
             row_meta[r] = {
-                'Y': row_dates[r]['Y'],
-                'R': row_dates[r]['R'],
+                'Y': date_strs[first_y[i]],
+                'R': date_strs[first_r[i]],
                 'cov_wh': wh_months,
                 'cov_it': all_months
             }
 
-    # ── 6. Modification Phase (Insert Columns) ────────────────────────────────
-    # We want to insert BEFORE the first demand column
+    # The new columns go BEFORE the first demand column
     if req_cols:
         insert_idx = min(req_cols.keys())
     else:
-        insert_idx = ws.max_column + 1
+        insert_idx = len(headers) + 1
+
+    return header_row, insert_idx, row_meta, cell_colors
 
-    # Insert 4 columns: First Y, First R, Cov WH, Cov IT
-    ws.insert_cols(insert_idx, 4)
 
-    # Write Headers
+def write_coverage_sheet(wb, title, rows, header_row, insert_idx,
+                         row_meta, cell_colors, freeze=None):
+    """Stream the rows to a new sheet of wb with the coverage columns spliced in."""
+    ws = wb.create_sheet(title)
+
+    # One fill per status color, shared by every colored cell
+    fills = {
+        color: PatternFill(start_color=color, end_color=color, fill_type="solid")
+        for color in (GREEN, YELLOW, RED)
+    }
+    bold = Font(bold=True)
     titles = ["First Yellow Date", "First Red Date", "Cov (WH)", "Cov (WH+IT)"]
-    for i, t in enumerate(titles):
-        c = ws.cell(row=header_row, column=insert_idx + i)
-        c.value = t
-        c.font = Font(bold=True)
-
-    # ── 7. Write Data & Apply Formatting ──────────────────────────────────────
-    for r in range(header_row + 1, ws.max_row + 1):
-        # A. Write New Columns
+    cut = insert_idx - 1
+
+    def extra_cells(r):
+        if r == header_row:
+            return list(titles)
         if r in row_meta:
             m = row_meta[r]
-            ws.cell(r, insert_idx).value = m['Y'] or "-"
-            ws.cell(r, insert_idx+1).value = m['R'] or "-"
-            ws.cell(r, insert_idx+2).value = m['cov_wh']
-            ws.cell(r, insert_idx+3).value = m['cov_it']
-
-        # B. Color Demand Cells (Shifted by 4)
-        if r in cell_colors:
-            for old_col, color in cell_colors[r].items():
-                # If the column was at or after insertion point, shift it
-                target_col = old_col + 4 if old_col >= insert_idx else old_col
-                ws.cell(r, target_col).fill = color
-
-    # ── 8. Autofit Columns ────────────────────────────────────────────────────
-    for i in range(1, ws.max_column + 1):
-        col_letter = get_column_letter(i)
-        max_len = 0
-        # Check first 100 rows to speed up
-        for r in range(1, min(ws.max_row, 100) + 1):
-            val = ws.cell(r, i).value
-            if val:
-                try:
-                    length = len(str(val))
-                    if length > max_len: max_len = length
-                except: pass
-        
-        # Add padding
-        adjusted_width = (max_len + 2) * 1.1
-        ws.column_dimensions[col_letter].width = max(adjusted_width, 8) # Min width 8
-
+            return [m['Y'] or "-", m['R'] or "-", m['cov_wh'], m['cov_it']]
+        return [None] * 4
+
+    # ── 1. Autofit Columns (must be set before any row is written) ────────────
+    # Check first 100 rows to speed up; blank/zero cells count as empty
+    sample = np.array(
+        [row[:cut] + tuple(extra_cells(r)) + row[cut:]
+         for r, row in enumerate(rows[:100], 1)],
+        dtype=object,
+    )
+    if sample.size:
+        str_len = np.frompyfunc(lambda v: len(str(v)) if v else 0, 1, 1)
+        max_len = str_len(sample).max(axis=0).astype(np.float64)
+        # Add padding, min width 8
+        widths = np.maximum((max_len + 2) * 1.1, 8)
+        for i, width in enumerate(widths, 1):
+            ws.column_dimensions[get_column_letter(i)].width = float(width)
+
+    # Keep the source sheet's frozen panes, if it had any
+    ws.freeze_panes = freeze
+
+    # ── 2. Write Data & Apply Formatting ──────────────────────────────────────
+    for r, row in enumerate(rows, 1):
+        values = list(row)
+        for col, color in cell_colors.get(r, {}).items():
+            cell = WriteOnlyCell(ws, value=values[col-1])
+            cell.fill = fills[color]
+            values[col-1] = cell
+
+        extra = extra_cells(r)
+        if r == header_row:
+            extra = [WriteOnlyCell(ws, value=t) for t in extra]
+            for cell in extra:
+                cell.font = bold
+
+        # Splice the new columns in place: one list insert per row, no
+        # cell shifting and no column remapping for the fills above
+        values[cut:cut] = extra
+        ws.append(values)
+
+
+def write_workbook(output_path, sheets, title, header_row, insert_idx,
+                   row_meta, cell_colors, panes=None):
+    """Write every sheet back in order; only `title` gets the coverage columns."""
+    panes = panes or {}
+    wb = Workbook(write_only=True)
+    for name, rows in sheets:
+        if name == title:
+            write_coverage_sheet(wb, name, rows, header_row, insert_idx,
+                                 row_meta, cell_colors, panes.get(name))
+        else:
+            # The other sheets are carried over as values (and frozen panes)
+            ws = wb.create_sheet(name)
+            ws.freeze_panes = panes.get(name)
+            for row in rows:
+                ws.append(row)
     wb.save(output_path)
+
+
+def apply_conditional_formatting(
+    input_path,
+    output_path,
+    sheet_name: str = "Schedule",
+    part_col_header: str = "PART",
+):
+    sheets = read_sheets(input_path)
+    titles = [name for name, _ in sheets]
+    title = sheet_name if sheet_name in titles else titles[0]
+    rows = sheets[titles.index(title)][1]
+    header_row, insert_idx, row_meta, cell_colors = compute_colors(
+        rows, part_col_header
+    )
+    write_workbook(output_path, sheets, title, header_row, insert_idx,
+                   row_meta, cell_colors, read_freeze_panes(input_path))
     logging.info(f"Saved updated coverage report to {output_path}")
 
 
@@ -305,7 +425,7 @@ def aggregate_edi_from_path(path):
     ends   = [s + pd.DateOffset(months=1) - pd.Timedelta(days=1) for s in starts]
     labels = [s.strftime('%Y-%m') for s in starts]
 
-    xls = pd.ExcelFile(path)
+    xls = pd.ExcelFile(path, engine='calamine')
     sheets = [s for s in xls.sheet_names if TARGET.lower() in s.lower()]
     if not sheets:
         raise ValueError(f"No '{TARGET}' sheet in {os.path.basename(path)}")
@@ -320,9 +440,12 @@ def aggregate_edi_from_path(path):
     if hdr is None:
         raise ValueError(f"Header row not found in {os.path.basename(path)}")
 
-    df = pd.read_excel(xls, sheet_name=sheet, header=hdr)
-    df.columns = [str(c).strip() for c in df.columns]
-    df.fillna(0, inplace=True)
+    # slice header + body out of the one parse instead of reading the sheet again
+    df = raw.iloc[hdr+1:].reset_index(drop=True)
+    df.columns = [str(c).strip() for c in raw.iloc[hdr]]
+    df = df.loc[:, ~df.columns.duplicated()]
+    with pd.option_context('future.no_silent_downcasting', True):
+        df = df.fillna(0).infer_objects()
     if 'Part No' in df: df.rename(columns={'Part No':'PART'}, inplace=True)
     if 'Plant'   in df: df.rename(columns={'Plant':'PLANT'},   inplace=True)
 
@@ -355,7 +478,46 @@ def aggregate_edi_from_path(path):
     return summary, labels
 
 
+# ——— Helper 3: stream a DataFrame to an in-memory .xlsx ——————————————————
+def frame_to_xlsx(df, sheet_name):
+    """Same sheet as df.to_excel(index=False), written through a write-only workbook."""
+    output = io.BytesIO()
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+
+    # pandas' header look: bold, thin box border, centred at the top
+    thin = Side(style='thin')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    bold = Font(bold=True)
+    align = Alignment(horizontal='center', vertical='top')
+    header = []
+    for col in df.columns:
+        cell = WriteOnlyCell(ws, value=col)
+        cell.font, cell.border, cell.alignment = bold, border, align
+        header.append(cell)
+    ws.append(header)
+
+    # missing values become empty cells, as with to_excel's default na_rep
+    values = df.astype(object).where(df.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        ws.append(row)
+
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
 # ——— Task 1: HTML → Schedule.xlsx —————————————————————————————————————
+HTML_PARSER = lh.HTMLParser(encoding='utf-8')
+# Selectors are compiled once; per part and per forecast row they are only run
+FROM_LABEL = etree.XPath('(//b[normalize-space(text())="From:"])[1]')
+LABELS_AND_TABLES = etree.XPath(
+    '//td[contains(text(), "Buyer\'s Part Number:")] | //table[.//div[@date]]')
+NEXT_TD = etree.XPath('following-sibling::td[1]')
+TABLE_ROWS = etree.XPath('.//tr')
+ROW_CELLS = etree.XPath('.//td')
+DATE_DIV = etree.XPath('.//div[@date]')
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -377,104 +539,113 @@ def convert():
     WEEKCOLS = [d.strftime('%Y-%m-%d') for d in weeks]
     OUTCOLS = ['PLANT', 'PART', 'Route', 'Project'] + WEEKCOLS + ['Grand Total']
 
-    rows = []
+    def text_of(el):
+        # Equivalent of bs4's get_text(strip=True)
+        return ''.join(t.strip() for t in el.itertext())
+
+    # One entry per part; forecasts are collected flat and bucketed at the end
+    parts, part_ids, qtys, dates = [], [], [], []
     for f in files:
         try:
-            html = f.stream.read().decode('utf-8')
-            soup = BeautifulSoup(html, 'html.parser')
+            # raw bytes: lxml rejects str input with an encoding declaration
+            tree = lh.document_fromstring(f.stream.read(), parser=HTML_PARSER)
 
             # Extract plant
             plant = ''
-            b_from = soup.find('b', string=lambda t: t and t.strip() == 'From:')
+            b_from = FROM_LABEL(tree)
             if b_from:
-                sib = b_from.next_sibling
-                if sib and isinstance(sib, str) and sib.strip():
+                sib = b_from[0].tail
+                if sib and sib.strip():
                     plant = sib.strip()
                 else:
-                    plant = b_from.parent.get_text().replace('From:', '').strip()
-
-            # Extract parts and forecasts
-            for part_td in soup.find_all(
-                    'td', string=lambda t: t and "Buyer's Part Number:" in t):
-                # Part number
-                next_td = part_td.find_next_sibling('td')
-                part = next_td.get_text(strip=True) if next_td else ''
-
-                data_week = {wk: 0 for wk in WEEKCOLS}
-                # Locate forecast table
-                table = None
-                for tbl in part_td.find_all_next('table'):
-                    if tbl.find('div', attrs={'date': True}):
-                        table = tbl
-                        break
-
-                if table:
-                    for tr in table.find_all('tr')[1:]:
-                        cells = tr.find_all('td')
-                        if len(cells) < 3:
-                            continue
-                        qty_text = cells[0].get_text(strip=True)
-                        date_div = cells[2].find('div', attrs={'date': True})
-                        if not qty_text or date_div is None:
-                            continue
-                        try:
-                            qty = float(qty_text)
-                        except ValueError:
-                            continue
-                        date_str = date_div['date']
-                        dt = None
-                        for fmt in ('%y%m%d', '%Y%m%d'):
-                            try:
-                                dt = datetime.strptime(date_str, fmt).date()
-                                break
-                            except ValueError:
-                                continue
-                        if not dt:
-                            continue
-                        monday = dt - timedelta(days=dt.weekday())
-                        wk = monday.strftime('%Y-%m-%d')
-                        if wk in data_week:
-                            data_week[wk] += qty
-
-                grand_total = sum(data_week.values())
-                rows.append({
-                    'PLANT': plant,
-                    'PART': part,
-                    'Route': '',
-                    'Project': '',
-                    **data_week,
-                    'Grand Total': grand_total
-                })
+                    plant = b_from[0].getparent().text_content().replace('From:', '').strip()
+
+            # Extract parts and forecasts. Labels and forecast tables come
+            # back in document order, so each part takes the next table
+            # after its label without a following:: scan per part
+            pending = []
+            for el in LABELS_AND_TABLES(tree):
+                if el.tag == 'td':
+                    # Part number
+                    next_td = NEXT_TD(el)
+                    part = text_of(next_td[0]) if next_td else ''
+                    pending.append(len(parts))
+                    parts.append((plant, part))
+                    continue
+
+                # Forecast table for every part waiting on one
+                for tr in TABLE_ROWS(el)[1:]:
+                    cells = ROW_CELLS(tr)
+                    if len(cells) < 3:
+                        continue
+                    qty_text = text_of(cells[0])
+                    date_div = DATE_DIV(cells[2])
+                    if not qty_text or not date_div:
+                        continue
+                    for pid in pending:
+                        part_ids.append(pid)
+                        qtys.append(qty_text)
+                        dates.append(date_div[0].get('date'))
+                pending = []
         except Exception as e:
             logging.warning(f"Error parsing HTML {f.filename}: {e}")
 
-    if not rows:
+    if not parts:
         flash('No data found in HTML files.')
         return redirect(url_for('convert'))
 
-    # Build Excel workbook
-    df = pd.DataFrame(rows, columns=OUTCOLS)
+    # Parse every forecast date at once ('%y%m%d' first, then '%Y%m%d'),
+    # snap to its Monday and sum quantities per part and week
+    date_s = pd.Series(dates, dtype=object)
+    dt = pd.to_datetime(date_s, format='%y%m%d', errors='coerce').fillna(
+        pd.to_datetime(date_s, format='%Y%m%d', errors='coerce'))
+    monday = dt - pd.to_timedelta(dt.dt.weekday, unit='D')
+    wk = monday.dt.strftime('%Y-%m-%d')
+    qty = pd.to_numeric(pd.Series(qtys, dtype=object), errors='coerce')
+    weekly = (
+        qty.groupby([pd.Series(part_ids, dtype='int64'), wk]).sum()
+        .unstack(fill_value=0)
+        .reindex(index=range(len(parts)), columns=WEEKCOLS, fill_value=0)
+    )
+
+    # Assemble column-wise, already in output order
+    data = {
+        'PLANT': [plant for plant, _ in parts],
+        'PART': [part for _, part in parts],
+        'Route': '',
+        'Project': '',
+    }
+    data.update(weekly.items())
+    data['Grand Total'] = weekly.sum(axis=1)
+    df = pd.DataFrame(data, columns=OUTCOLS)
+
+    # Build Excel workbook (streamed; widths and panes go in before any row)
     buf = io.BytesIO()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = 'Merged'
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Merged')
+
+    # Column widths from the frame itself: blanks/zeros count as empty
+    text = df.where(df.astype(bool), '').astype(str)
+    data_len = text.apply(lambda c: c.str.len().max())
+    for i, col in enumerate(OUTCOLS, start=1):
+        max_len = max(len(col), int(data_len[col]))
+        ws.column_dimensions[get_column_letter(i)].width = max_len + 2
+    ws.freeze_panes = 'A2'
 
     bold = Font(bold=True)
-    for idx, col in enumerate(OUTCOLS, start=1):
-        cell = ws.cell(row=1, column=idx, value=col)
+    center = Alignment(horizontal='center')
+    header = []
+    for col in OUTCOLS:
+        cell = WriteOnlyCell(ws, value=col)
         cell.font = bold
-        cell.alignment = Alignment(horizontal='center')
+        cell.alignment = center
+        header.append(cell)
+    ws.append(header)
 
-    for r_idx, tup in enumerate(df.itertuples(index=False), start=2):
-        for c_idx, val in enumerate(tup, start=1):
-            ws.cell(row=r_idx, column=c_idx, value=val)
+    for tup in df.itertuples(index=False, name=None):
+        ws.append(tup)
 
-    ws.freeze_panes = 'A2'
-    for i, col_cells in enumerate(ws.columns, start=1):
-        max_len = max(len(str(c.value)) if c.value else 0 for c in col_cells)
-        ws.column_dimensions[get_column_letter(i)].width = max_len + 2
-
-        # Save workbook to buffer
+    # Save workbook to buffer
     wb.save(buf)
     # Return workbook directly
     buf.seek(0)
@@ -496,7 +667,7 @@ def coverage():
         flash("Valid Excel required"); return redirect(url_for("coverage"))
 
     tmp_in = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-    tmp_in.write(f.read()); tmp_in.flush()
+    shutil.copyfileobj(f.stream, tmp_in, length=1024 * 1024); tmp_in.flush()
     tmp_out = tmp_in.name.replace(".xlsx","_coverage.xlsx")
 
     apply_conditional_formatting(tmp_in.name, tmp_out,
@@ -518,7 +689,7 @@ def fluctuations():
     for f in uploaded:
         if f and f.filename.lower().endswith(".xlsx"):
             tf = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-            tf.write(f.read()); tf.flush()
+            shutil.copyfileobj(f.stream, tf, length=1024 * 1024); tf.flush()
             paths.append(tf.name)
 
     if len(paths) < 3:
@@ -565,22 +736,18 @@ def fluctuations():
             cols = [f"{m}_{prefix}" for m in months]
             merged[f"Total_{prefix}"] = merged[cols].sum(axis=1)
 
-        def pct_change(row):
-            old_val    = row["Total_old"]
-            latest_val = row["Total_latest"]
-            if old_val == 0:
-            # both zero → 0%, otherwise infinite growth → cap at 100%
-               return 0 if latest_val == 0 else 100
-        # normal % change
-            return (latest_val - old_val) / old_val * 100
-
-        merged["Fluctuation_%"] = merged.apply(pct_change, axis=1)
+        # % change old → latest; from zero: both zero → 0%, otherwise cap at 100%
+        old_tot    = merged["Total_old"].to_numpy()
+        latest_tot = merged["Total_latest"].to_numpy()
+        safe_old   = np.where(old_tot == 0, 1, old_tot)
+        merged["Fluctuation_%"] = np.where(
+            old_tot == 0,
+            np.where(latest_tot == 0, 0.0, 100.0),
+            (latest_tot - old_tot) / safe_old * 100,
+        )
 
         # write to Excel in-memory
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            merged.to_excel(writer, sheet_name="Fluctuation", index=False)
-        output.seek(0)
+        output = frame_to_xlsx(merged, "Fluctuation")
 
         return send_file(
             output,
@@ -605,101 +772,97 @@ def generate_unmet_requirements_excel(
     window_weeks: int = 8,
     date_formats=(' %d-%m-%Y', '%Y-%m-%d', '%y%m%d', '%Y%m%d')
 ) -> io.BytesIO:
-    wb = load_workbook(input_xlsx, data_only=True)
-    ws = wb[sheet_name]
-
-    # 1) Find header row by "Stock"
-    header_row = next(
-        (cell.row
-         for row in ws.iter_rows(min_row=1, max_row=20)
-         for cell in row
-         if cell.value and re.search(r'\bStock\b', str(cell.value), re.IGNORECASE)),
-        None
-    )
-    if header_row is None:
-        raise ValueError("Header row containing 'Stock' not found.")
-
-    # 2) Read header values
-    headers = [cell.value for cell in ws[header_row]]
+    wb = load_workbook(input_xlsx, read_only=True, data_only=True)
+    # read-only keeps the file open until close(), on every path
+    try:
+        ws = wb[sheet_name]
 
-    # 3) Flexible date parser
-    def parse_date(v):
-        # a) already datetime
-        if isinstance(v, datetime):
-            return v
-        # b) Excel serial number
-        if isinstance(v, (int, float)):
-            try:
-                return from_excel(v)
-            except:
-                pass
-        # c) string formats
-        for fmt in date_formats:
-            try:
-                return datetime.strptime(str(v).strip(), fmt)
-            except:
-                continue
-        return None
+        # 1) Find header row by "Stock". One iterator streams the sheet once:
+        #    the header search consumes the top rows and step 7 carries on from it
+        rows = ws.iter_rows()
+        headers = None
+        for row in islice(rows, 20):
+            if any(cell.value and STOCK_RE.search(str(cell.value)) for cell in row):
+                # 2) Read header values
+                headers = [cell.value for cell in row]
+                break
+        if headers is None:
+            raise ValueError("Header row containing 'Stock' not found.")
+
+        # 3) Flexible date parser
+        def parse_date(v):
+            # a) already datetime
+            if isinstance(v, datetime):
+                return v
+            # b) Excel serial number
+            if isinstance(v, (int, float)):
+                try:
+                    return from_excel(v)
+                except (ValueError, OverflowError):
+                    pass
+            # c) string formats
+            s = str(v).strip()
+            for fmt in date_formats:
+                try:
+                    return datetime.strptime(s, fmt)
+                except ValueError:
+                    continue
+            return None
+
+        # 4) Collect date columns
+        parsed = [(idx, parse_date(hdr))
+                  for idx, hdr in enumerate(headers, start=1)]
+        # only keep those we parsed successfully
+        parsed_dates = [(i,d) for i,d in parsed if d]
+        if not parsed_dates:
+            raise ValueError("No date‑formatted headers found.")
+
+        # window
+        start_date = min(d for _,d in parsed_dates)
+        end_date   = start_date + timedelta(weeks=window_weeks)
+        req_date_cols = [(i,d) for i,d in parsed_dates
+                         if start_date <= d <= end_date]
+
+        # 5) Find PART and Plant columns
+        part_col  = next(i for i,h in enumerate(headers,1)
+                         if h and re.search(r'\bPART\b', str(h), re.IGNORECASE))
+        plant_col = next(i for i,h in enumerate(headers,1)
+                         if h and re.search(r'\bPlant\b', str(h), re.IGNORECASE))
+
+        # 6) Red‑fill detector
+        def is_red(cell):
+            rgb = getattr(getattr(cell.fill, 'fgColor', None), 'rgb', '')
+            return 'FFC7CE' in (rgb or '').upper()
+
+        # 7) Scan rows for red cells; quantities are parsed in one batch below
+        data = []
+        width = len(headers)
+        for row in rows:
+            # writers that skip empty trailing cells leave short rows
+            if len(row) < width:
+                row += (EMPTY_CELL,) * (width - len(row))
+            part  = row[part_col-1].value
+            plant = row[plant_col-1].value
+            for col_idx, req_date in req_date_cols:
+                cell = row[col_idx-1]
+                if is_red(cell) and cell.value:
+                    data.append({
+                        'Part Number': part,
+                        'Plant': plant,
+                        'Requirement Date': req_date.date().isoformat(),
+                        'Unmet Qty': cell.value
+                    })
+    finally:
+        wb.close()
 
-    # 4) Collect date columns
-    parsed = [(idx, parse_date(hdr))
-              for idx, hdr in enumerate(headers, start=1)]
-    # only keep those we parsed successfully
-    parsed_dates = [(i,d) for i,d in parsed if d]
-    if not parsed_dates:
-        raise ValueError("No date‑formatted headers found.")
-
-    # window
-    start_date = min(d for _,d in parsed_dates)
-    end_date   = start_date + timedelta(weeks=window_weeks)
-    req_date_cols = [(i,d) for i,d in parsed_dates
-                     if start_date <= d <= end_date]
-
-    # 5) Find PART and Plant columns
-    part_col  = next(i for i,h in enumerate(headers,1)
-                     if h and re.search(r'\bPART\b', str(h), re.IGNORECASE))
-    plant_col = next(i for i,h in enumerate(headers,1)
-                     if h and re.search(r'\bPlant\b', str(h), re.IGNORECASE))
-
-    # 6) Red‑fill detector
-    def is_red(cell):
-        rgb = getattr(getattr(cell.fill, 'fgColor', None), 'rgb', '')
-        return 'FFC7CE' in (rgb or '').upper()
-
-    # 7) Scan rows for unmet (robust numeric parsing)
-    data = []
-    def parse_float_safe(v):
-        try:
-            return float(v)
-        except Exception:
-            try:
-                return float(str(v).replace(',', '').strip())
-            except Exception:
-                return 0.0
-
-    for row in ws.iter_rows(min_row=header_row+1, max_row=ws.max_row):
-        part  = row[part_col-1].value
-        plant = row[plant_col-1].value
-        for col_idx, req_date in req_date_cols:
-            cell = ws.cell(row=row[0].row, column=col_idx)
-            if is_red(cell) and cell.value and parse_float_safe(cell.value) > 0:
-                data.append({
-                    'Part Number': part,
-                    'Plant': plant,
-                    'Requirement Date': req_date.date().isoformat(),
-                    'Unmet Qty': parse_float_safe(cell.value)
-                })
-
-    # 8) Build and return Excel
+    # 8) Build and return Excel (only red cells with a positive quantity)
     df = pd.DataFrame(data, columns=[
         'Part Number', 'Plant', 'Requirement Date', 'Unmet Qty'
     ])
+    df['Unmet Qty'] = to_numbers(df['Unmet Qty'])
+    df = df[df['Unmet Qty'] > 0].reset_index(drop=True)
 
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Critical_Parts')
-    output.seek(0)
-    return output
+    return frame_to_xlsx(df, 'Critical_Parts')
 
 
 # ——— Route: Critical Parts —————————————————————————————————————
@@ -716,7 +879,7 @@ def critical_parts():
 
     # write temp
     tf = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-    tf.write(uploaded.read()); tf.flush(); tf.close()
+    shutil.copyfileobj(uploaded.stream, tf, length=1024 * 1024); tf.flush(); tf.close()
     try:
         excel_io = generate_unmet_requirements_excel(
             input_xlsx=tf.name,
@@ -1,3 +1,13 @@
+import os
+import sys
+
+OUT = 'static/images/logo.png'
+
+# The logo is checked in; only redraw it when the asset is missing
+if os.path.exists(OUT):
+    print(f'✓ Logo already present at {OUT}')
+    sys.exit(0)
+
 from PIL import Image, ImageDraw, ImageFont
 
 # Create a new image with transparency
@@ -20,5 +30,5 @@ except:
 draw.text((50, 35), 'U', fill='white', font=font)
 
 # Save the image
-img.save('static/images/logo.png')
-print('✓ Logo created successfully at static/images/logo.png')
+img.save(OUT)
+print(f'✓ Logo created successfully at {OUT}')
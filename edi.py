@@ -1,73 +1,156 @@
 # edi.py
-import pandas as pd, glob, os
-from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+import numpy as np, pandas as pd, glob, os
+from datetime import date
+from functools import lru_cache
+from bs4 import SoupStrainer
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
+from lxml import etree, html as lxml_html
+from lxml.html import soupparser
+import xlsxwriter
+
+# the schedule rows live in <table>s; the bs4 fallback builds nothing else.
+# The fallback goes through lxml.html.soupparser so parse_tree always gets
+# an lxml tree it can run XPath on
+ONLY_TABLES = SoupStrainer('table')
+UTF8_PARSER = lxml_html.HTMLParser(encoding='utf-8')
+
+
+def parse_tree(tree):
+    """
+    Extract one schedule page from its parsed tree.
+    Returns ((plant, part, route, project), [(date, qty), ...]).
+    """
+    # --- your existing parsing code here (XPath on tree); return the row
+    # fields plus one (date, qty) pair per scheduled delivery
+    #
+    # For demo: a dummy zero‑row
+    return ('Plant A', 'Part 123', 'R1', 'Proj X'), []
+
+
+def parse_html(html):
+    """Parse one schedule page given as a string (see parse_tree)."""
+    # libxml2 builds the tree in C; bs4 only picks up what lxml rejects
+    # (empty documents). Parse bytes: lxml refuses str input that carries
+    # an encoding declaration (<?xml ... encoding="utf-8"?>)
+    data = html.encode('utf-8') if isinstance(html, str) else html
+    try:
+        tree = lxml_html.document_fromstring(data, parser=UTF8_PARSER)
+    except etree.ParserError:
+        tree = soupparser.fromstring(html, features='lxml', parse_only=ONLY_TABLES)
+    return parse_tree(tree)
+
+
+def parse_html_file(fn):
+    """Parse one schedule page straight from disk (see parse_tree)."""
+    # lxml reads the file incrementally, so the raw markup is never held
+    tree = lxml_html.parse(fn, parser=UTF8_PARSER).getroot()
+    if tree is None:
+        with open(fn, 'r', encoding='utf-8') as f:
+            tree = soupparser.parse(f, features='lxml',
+                                    parse_only=ONLY_TABLES).getroot()
+    return parse_tree(tree)
+
+
+@lru_cache(maxsize=4)
+def schedule_weeks(day):
+    """The 52 week-start Mondays from day's week, plus the full output columns."""
+    start_monday = pd.Timestamp(day) - pd.Timedelta(days=day.weekday())
+    weeks = pd.date_range(start=start_monday, periods=52, freq='W-MON')
+    # week columns stay Timestamps; they are formatted only when written out
+    output_cols = (pd.Index(['PLANT','PART','Route','Project'])
+                   .append(weeks).append(pd.Index(['Grand Total'])))
+    return weeks, output_cols
+
 
 def build_schedule_df(html_folder=None, html_contents=None):
     """
     If html_folder is given, will glob *.html inside it.
     Alternatively, you can directly pass html_contents as a list of strings.
-    Returns a DataFrame with your columns + data.
+    Returns a DataFrame with your columns + data (week columns are Timestamps).
     """
-    # 1) determine week columns
-    today = pd.Timestamp.now().normalize()
-    start_monday = today - pd.Timedelta(days=today.weekday())
-    weeks = pd.date_range(start=start_monday, periods=52, freq='W-MON')
-    WEEK_COLS = [d.strftime('%Y-%m-%d') for d in weeks]
-    OUTPUT_COLS = ['PLANT','PART','Route','Project'] + WEEK_COLS + ['Grand Total']
+    # 1) determine week columns (built once per day)
+    weeks, OUTPUT_COLS = schedule_weeks(date.today())
 
-    # 2) load html
-    html_list = []
+    # 2) pick the page sources: in-memory strings, or file paths that each
+    #    worker opens and parses itself (peak memory is one page, not all)
     if html_contents:
-        html_list = html_contents
+        sources, parse = html_contents, parse_html
     elif html_folder:
-        for fn in glob.glob(os.path.join(html_folder, '*.html')):
-            with open(fn, 'r', encoding='utf-8') as f:
-                html_list.append(f.read())
+        sources = glob.glob(os.path.join(html_folder, '*.html'))
+        parse = parse_html_file
     else:
         raise ValueError("Need either html_folder or html_contents")
 
-    # 3) parse each file and build rows
-    rows = []
-    for html in html_list:
-        soup = BeautifulSoup(html, 'html.parser')
-        # --- your existing parsing code here; for each row append:
-        # rows.append([plant, part, route, project] + week_qtys + [sum(week_qtys)])
-        #
-        # For demo: a dummy zero‑row
-        rows.append(['Plant A','Part 123','R1','Proj X'] + [0]*52 + [0])
+    # 3) parse pages across processes (CPU-bound and independent), then
+    #    fill preallocated buffers: one row per page, text fields in a small
+    #    object array, quantities bucketed by week as int64
+    if len(sources) > 1:
+        chunksize = max(1, len(sources) // (4 * (os.cpu_count() or 1)))
+        with ProcessPoolExecutor() as ex:
+            parsed = list(ex.map(parse, sources, chunksize=chunksize))
+    else:
+        parsed = [parse(src) for src in sources]
+
+    meta = np.empty((len(parsed), 4), dtype=object)
+    qty = np.zeros((len(parsed), len(weeks)), dtype=np.int64)
+    rows, days, amounts = [], [], []
+    for i, (fields, deliveries) in enumerate(parsed):
+        meta[i] = fields
+        for d, q in deliveries:
+            rows.append(i); days.append(d); amounts.append(q)
+
+    # bucket every delivery in one go: weeks are sorted Mondays, so the
+    # week a day falls in is searchsorted(side='right') - 1; days before the
+    # first Monday or past the last week are dropped
+    week_days = weeks.to_numpy().astype('datetime64[D]')
+    when = np.array(days, dtype='datetime64[D]')
+    k = np.searchsorted(week_days, when, side='right') - 1
+    keep = (k >= 0) & (when < week_days[-1] + np.timedelta64(7, 'D'))
+    np.add.at(qty, (np.array(rows, dtype=np.intp)[keep], k[keep]),
+              np.array(amounts, dtype=np.int64)[keep])
 
-    return pd.DataFrame(rows, columns=OUTPUT_COLS)
+    # 4) assemble column-wise; totals are one reduction over the qty block
+    data = {col: meta[:, j] for j, col in enumerate(OUTPUT_COLS[:4])}
+    data.update({col: qty[:, k] for k, col in enumerate(weeks)})
+    data['Grand Total'] = qty.sum(axis=1)
+    return pd.DataFrame(data, columns=OUTPUT_COLS)
 
 
 def df_to_excel_bytes(df):
     """Turn a DataFrame into an in‑memory .xlsx file (BytesIO)."""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Schedule"
-
-    # header
-    bold = Font(bold=True)
-    for i, col in enumerate(df.columns, start=1):
-        cell = ws.cell(row=1, column=i, value=col)
-        cell.font = bold
-        cell.alignment = Alignment(horizontal='center')
-
-    # data rows
-    for r_idx, row in enumerate(df.itertuples(index=False), start=2):
-        for c_idx, val in enumerate(row, start=1):
-            ws.cell(row=r_idx, column=c_idx, value=val)
-
-    # auto‑width
-    for i, col_cells in enumerate(ws.columns, start=1):
-        maxlen = max(len(str(c.value)) for c in col_cells if c.value is not None)
-        ws.column_dimensions[get_column_letter(i)].width = maxlen + 2
-
     bio = BytesIO()
-    wb.save(bio)
+    # constant_memory streams each finished row to a temp file; ±inf
+    # become Excel errors rather than aborting the write (missing values are
+    # blanked below), and datetimes get openpyxl's default display format
+    wb = xlsxwriter.Workbook(bio, {'constant_memory': True,
+                                   'nan_inf_to_errors': True,
+                                   'default_date_format': 'yyyy-mm-dd h:mm:ss'})
+    ws = wb.add_worksheet("Schedule")
+
+    # header (date columns are written as YYYY-MM-DD labels)
+    header = [c.strftime('%Y-%m-%d') if isinstance(c, pd.Timestamp) else c
+              for c in df.columns]
+    bold = wb.add_format({'bold': True, 'align': 'center'})
+    ws.write_row(0, 0, header, bold)
+
+    # data rows: each block of rows comes out of the frame's arrays as plain
+    # lists in one conversion, instead of a tuple boxed per row; missing
+    # values (NaN/NaT/None) become empty cells
+    write_row = ws.write_row
+    for start in range(0, len(df), 5000):
+        block = df.iloc[start:start + 5000].astype(object)
+        block = block.where(block.notna(), None).to_numpy().tolist()
+        for r_idx, row in enumerate(block, start=start + 1):
+            write_row(r_idx, 0, row)
+
+    # auto‑width: longest value or header per column, measured column-wise
+    text = df.where(df.notna(), '').astype(str)
+    data_len = text.apply(lambda c: c.str.len().max()).fillna(0).to_numpy()
+    hdr_len = np.array([len(str(c)) for c in header])
+    for i, width in enumerate(np.maximum(data_len, hdr_len) + 2):
+        ws.set_column(i, i, int(width))
+
+    wb.close()
     bio.seek(0)
     return bio